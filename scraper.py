@@ -1,9 +1,21 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime
-import pandas as pd
-from io import StringIO
+import pyarrow as pa
+from pyarrow import csv as pacsv
 import time
-import csv
+import asyncio
+import random
+import os
+import json
+import shutil
+import aiohttp
+import orjson
+from aiolimiter import AsyncLimiter
+
+# Output row layout; every field is numeric, an enum or a string without ';', so no CSV quoting is needed
+ROW_TEMPLATE = '{};{};{};{};{};{};{:d};{};{};{:d};{};{:d}\r\n'
 
 class DailyTrainCollector:
     def __init__(self):
@@ -11,8 +23,26 @@ class DailyTrainCollector:
         self.gtfs_url = "https://gtfs.irail.be/nmbs/gtfs/latest/"
         timestamp = datetime.now().strftime("%Y%m%d_%H%M")
         self.output_file = f'daily_trains_{timestamp}.csv'
+        self.max_concurrency = 16
+        self.requests_per_second = 3
+        self.max_retries = 5
+        # Token bucket: bursts go out immediately, sustained rate stays within API limits
+        self.limiter = AsyncLimiter(self.requests_per_second, 1)
+        self.headers = {'Accept-Encoding': 'gzip', 'User-Agent': 'train-scraper/1.0'}
+        self.gtfs_cache_dir = 'gtfs_cache'
+        self.flush_every = 50  # Vehicles written between flushes of the output file
+        self.vehicles_since_flush = 0
+        self.setup_session()
         self.setup_csv()
 
+    def setup_session(self):
+        """Setup HTTP session with connection pooling and retries"""
+        self.session = requests.Session()
+        retries = Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 502, 503, 504])
+        adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=retries)
+        self.session.mount('https://', adapter)
+        self.session.headers.update(self.headers)
+
     def setup_csv(self):
         """Setup CSV file with headers"""
         headers = [
@@ -29,50 +59,101 @@ class DailyTrainCollector:
             'platform',
             'is_cancelled'
         ]
-        self.csv_file = open(self.output_file, 'w', newline='', encoding='utf-8')
-        self.csv_writer = csv.writer(self.csv_file, delimiter=';')
-        self.csv_writer.writerow(headers)
+        self.csv_file = open(self.output_file, 'w', newline='', encoding='utf-8', buffering=1 << 20)  # 1 MiB write buffer
+        self.csv_file.write(';'.join(headers) + '\r\n')
         print(f"Created output file: {self.output_file}")
 
+    def download_gtfs_file(self, filename):
+        """Download a GTFS file to the local cache, skipping the body if unchanged"""
+        os.makedirs(self.gtfs_cache_dir, exist_ok=True)
+        path = os.path.join(self.gtfs_cache_dir, filename)
+        meta_path = f"{path}.json"
+        
+        # Send the validators of the cached copy so the server can answer 304 Not Modified
+        headers = {}
+        if os.path.exists(path) and os.path.exists(meta_path):
+            with open(meta_path, encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        
+        with self.session.get(f"{self.gtfs_url}{filename}", headers=headers, stream=True) as response:
+            if response.status_code == 304:
+                print(f"{filename} not modified, using cached copy")
+                return path
+            
+            response.raise_for_status()
+            response.raw.decode_content = True  # Let urllib3 undo the gzip encoding
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'wb') as f:
+                shutil.copyfileobj(response.raw, f, 1 << 20)
+            os.replace(tmp_path, path)
+            
+            with open(meta_path, 'w', encoding='utf-8') as f:
+                json.dump({
+                    'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified')
+                }, f)
+        
+        return path
+
+    def read_gtfs_file(self, filename, column_types):
+        """Read the given columns of a GTFS file into a DataFrame, downloading it only if it changed"""
+        path = self.download_gtfs_file(filename)
+        # Arrow parses with multiple threads; column types are applied while parsing,
+        # so IDs like "0567" keep their leading zeros
+        table = pacsv.read_csv(
+            path,
+            read_options=pacsv.ReadOptions(use_threads=True),
+            convert_options=pacsv.ConvertOptions(
+                include_columns=list(column_types),
+                column_types=column_types
+            )
+        )
+        return table.to_pandas()
+
     def get_gtfs_data(self):
         """Get scheduled trains from GTFS data"""
         print("Downloading GTFS data...")
         try:
             # Get trips file
             print("Downloading trips data...")
-            trips_response = requests.get(f"{self.gtfs_url}trips.txt")
-            trips_df = pd.read_csv(StringIO(trips_response.text))
-            
-            # Get stop_times file
-            print("Downloading stop times data...")
-            stop_times_response = requests.get(f"{self.gtfs_url}stop_times.txt")
-            stop_times_df = pd.read_csv(StringIO(stop_times_response.text))
+            trips_df = self.read_gtfs_file('trips.txt', {'trip_short_name': pa.string()})
             
-            # Get unique train IDs from trips
-            train_ids = set()
-            for _, trip in trips_df.iterrows():
-                train_id = trip.get('trip_short_name')
-                if train_id is not None:
-                    # Convert to string if it's an integer
-                    train_id = str(train_id).strip()
-                    if train_id:  # Only add if not empty after stripping
-                        train_ids.add(train_id)
+            # Get unique train IDs from trips, skipping names that are empty after stripping
+            train_ids = trips_df['trip_short_name'].dropna().str.strip()
+            train_ids = train_ids[train_ids != ''].drop_duplicates().tolist()
             
             print(f"Found {len(train_ids)} unique train IDs in GTFS data")
-            return list(train_ids)
+            return train_ids
             
         except Exception as e:
             print(f"Error getting GTFS data: {e}")
             return []
 
     def format_time(self, timestamp):
-        """Convert timestamp to HH:MM format"""
+        """Convert an integer timestamp to HH:MM format (local time)"""
         try:
-            return datetime.fromtimestamp(int(timestamp)).strftime('%H:%M')
-        except:
+            return time.strftime('%H:%M', time.localtime(timestamp))
+        except (OverflowError, OSError, TypeError, ValueError):
             return ""
 
-    def process_vehicle(self, vehicle_id):
+    async def fetch_vehicle(self, session, params):
+        """Fetch vehicle data, backing off with jitter when rate limited"""
+        for attempt in range(self.max_retries + 1):
+            async with self.limiter:
+                async with session.get(f"{self.base_url}vehicle/", params=params) as response:
+                    if response.status != 429 or attempt == self.max_retries:
+                        response.raise_for_status()
+                        return orjson.loads(await response.read())
+            
+            delay = min(60, 2 ** attempt + random.random())
+            print(f"Rate limited on train {params['id']}, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    async def process_vehicle(self, session, vehicle_id):
         """Process a single vehicle's data"""
         params = {
             'id': vehicle_id,
@@ -81,9 +162,7 @@ class DailyTrainCollector:
         }
         
         try:
-            response = requests.get(f"{self.base_url}vehicle/", params=params)
-            response.raise_for_status()
-            data = response.json()
+            data = await self.fetch_vehicle(session, params)
             
             vehicle_info = data.get('vehicleinfo', {})
             stops = data.get('stops', {}).get('stop', [])
@@ -93,11 +172,12 @@ class DailyTrainCollector:
                 print(f"No stops found for train {vehicle_id}")
                 return False
             
-            train_id = vehicle_info.get('name', '').replace('BE.NMBS.', '')
-            train_type = vehicle_info.get('type', '')
+            train_id = vehicle_info.get('name', '').replace('BE.NMBS.', '').replace(';', ',')
+            train_type = vehicle_info.get('type', '').replace(';', ',')
             
             print(f"Processing {total_stops} stops for train {train_id}")
             has_cancellations = False
+            lines = []
             
             for i, stop in enumerate(stops):
                 # Determine position
@@ -117,20 +197,21 @@ class DailyTrainCollector:
                 departure_delay = int(stop.get('departureDelay', "0"))
                 actual_departure = scheduled_departure + departure_delay
                 
-                # Check cancellation
-                is_cancelled = (stop.get('canceled', 0) == 1 or 
-                              stop.get('arrivalCanceled', 0) == 1 or 
-                              stop.get('departureCanceled', 0) == 1)
+                # Check cancellation (iRail sends the flags as strings, e.g. "1")
+                is_cancelled = (str(stop.get('canceled', 0)) == '1' or 
+                              str(stop.get('arrivalCanceled', 0)) == '1' or 
+                              str(stop.get('departureCanceled', 0)) == '1')
                 
+                station = str(stop.get('station', '')).replace(';', ',')
                 if is_cancelled:
                     has_cancellations = True
-                    print(f"  Found cancellation at {stop.get('station', '')}")
+                    print(f"  Found cancellation at {station}")
                 
                 # Create row
-                row = [
+                lines.append(ROW_TEMPLATE.format(
                     train_id,
                     train_type,
-                    stop.get('station', ''),
+                    station,
                     position,
                     self.format_time(scheduled_arrival),
                     self.format_time(actual_arrival),
@@ -138,13 +219,16 @@ class DailyTrainCollector:
                     self.format_time(scheduled_departure),
                     self.format_time(actual_departure),
                     departure_delay // 60,  # Convert to minutes
-                    stop.get('platform', ''),
+                    str(stop.get('platform', '')).replace(';', ','),
                     1 if is_cancelled else 0
-                ]
-                
-                self.csv_writer.writerow(row)
+                ))
             
-            self.csv_file.flush()
+            # Write all stops of this vehicle in one call
+            self.csv_file.write(''.join(lines))
+            self.vehicles_since_flush += 1
+            if self.vehicles_since_flush >= self.flush_every:
+                self.csv_file.flush()
+                self.vehicles_since_flush = 0
             
             if has_cancellations:
                 print(f"Found cancellations for train {train_id}")
@@ -155,6 +239,36 @@ class DailyTrainCollector:
             print(f"Error processing vehicle {vehicle_id}: {e}")
             return False
 
+    async def process_all_vehicles(self, train_ids, start_time):
+        """Process all vehicles concurrently, bounded by max_concurrency"""
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency)
+        counts = {'started': 0, 'done': 0, 'processed': 0, 'errors': 0}
+
+        async def process_bounded(session, train_id):
+            async with semaphore:
+                counts['started'] += 1
+                print(f"\nProcessing train {counts['started']}/{len(train_ids)}: {train_id}")
+                
+                if await self.process_vehicle(session, train_id):
+                    counts['processed'] += 1
+                else:
+                    counts['errors'] += 1
+                counts['done'] += 1
+                
+                # Progress update every 10 trains
+                if counts['done'] % 10 == 0:
+                    print(f"\nProgress update:")
+                    print(f"Processed: {counts['done']}/{len(train_ids)} trains")
+                    print(f"Success: {counts['processed']}")
+                    print(f"Errors: {counts['errors']}")
+                    print(f"Time elapsed: {datetime.now() - start_time}")
+
+        async with aiohttp.ClientSession(connector=connector, headers=self.headers) as session:
+            await asyncio.gather(*(process_bounded(session, train_id) for train_id in train_ids))
+        
+        return counts['processed'], counts['errors']
+
     def collect_data(self):
         """Main data collection method"""
         print("\nStarting data collection for all daily trains...")
@@ -168,33 +282,13 @@ class DailyTrainCollector:
             return
         
         print(f"\nFound {len(train_ids)} trains to process")
-        processed = 0
-        errors = 0
-        cancelled_count = 0
         
-        # Process each train
-        for i, train_id in enumerate(train_ids, 1):
-            print(f"\nProcessing train {i}/{len(train_ids)}: {train_id}")
-            
-            try:
-                if self.process_vehicle(train_id):
-                    processed += 1
-                else:
-                    errors += 1
-                
-                # Progress update every 10 trains
-                if i % 10 == 0:
-                    print(f"\nProgress update:")
-                    print(f"Processed: {i}/{len(train_ids)} trains")
-                    print(f"Success: {processed}")
-                    print(f"Errors: {errors}")
-                    print(f"Time elapsed: {datetime.now() - start_time}")
-                
-            except Exception as e:
-                print(f"Error processing train {train_id}: {e}")
-                errors += 1
-            
-            time.sleep(1)  # Respect API rate limits
+        # Process trains concurrently; the limiter keeps the request rate in check
+        try:
+            processed, errors = asyncio.run(self.process_all_vehicles(train_ids, start_time))
+        finally:
+            # Make sure buffered rows reach disk, also when interrupted with Ctrl-C
+            self.csv_file.flush()
         
         end_time = datetime.now()
         duration = end_time - start_time
@@ -211,6 +305,8 @@ class DailyTrainCollector:
         """Cleanup"""
         if hasattr(self, 'csv_file'):
             self.csv_file.close()
+        if hasattr(self, 'session'):
+            self.session.close()
 
 if __name__ == "__main__":
     collector = DailyTrainCollector()